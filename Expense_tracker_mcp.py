@@ -1,7 +1,16 @@
+import asyncio
+import hashlib
+import hmac
 import logging
 import os
-import requests
+import tempfile
+import bcrypt
+import httpx
+import orjson
+from cachetools import TTLCache
+from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 from pathlib import Path
 
@@ -34,6 +43,41 @@ HEADERS = {
     "Prefer": "return=representation"  # tells supabase to return the created/updated row
 }
 
+# how dates are shown in tool output
+DISPLAY_DATE_FMT = "%Y-%m-%d %H:%M"
+
+# upper bound (seconds) on any single supabase call, so a slow query fails fast
+# instead of stalling the tool call (and the client waiting on it) indefinitely
+REQUEST_TIMEOUT = 10
+
+# one shared async client for the whole process so every tool call reuses pooled keep-alive
+# connections instead of paying a fresh TCP + TLS handshake per supabase request,
+# and a tool waiting on supabase doesn't block the server from handling other calls
+# http2 lets concurrent tool calls multiplex over the same connection
+CLIENT = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    headers=HEADERS,
+    timeout=REQUEST_TIMEOUT,
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
+
+# init_tables() remembers the last schema it applied here, so restarts on the same host
+# skip the DDL round trip unless the SQL (or the supabase project) changed.
+# set RUN_MIGRATIONS=0 to never run it
+SCHEMA_SENTINEL = Path(tempfile.gettempdir()) / "expense_tracker_schema.sha256"
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "1") != "0"
+
+# transient errors get retried with exponential backoff
+# a 429 means supabase rejected the request outright, so any method is safe to resend
+# gateway errors may hide a request that did land, so only idempotent methods retry those
+RATE_LIMIT_STATUS = 429
+RETRY_STATUSES = {502, 503, 504}
+RETRY_METHODS = {"GET", "DELETE"}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+MAX_RETRY_DELAY = 5  # seconds, a longer Retry-After isn't worth holding a tool call for
+
 
 # Table Init
 
@@ -84,76 +128,233 @@ def init_tables():
         timestamp FLOAT NOT NULL,
         date TEXT NOT NULL
     );
+
+    -- one index per query shape the tools use, every query is scoped to a single user
+    -- month filters and recent-first listings are range scans on (user_id, timestamp)
+    CREATE INDEX IF NOT EXISTS idx_expenses_user_ts ON expenses(user_id, timestamp DESC);
+    CREATE INDEX IF NOT EXISTS idx_expenses_user_cat_ts ON expenses(user_id, category, timestamp DESC);
+    CREATE INDEX IF NOT EXISTS idx_recurring_user_day ON recurring_expenses(user_id, day_of_month);
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_ts ON chat_history(user_id, timestamp DESC);
+    -- budgets is already covered by its UNIQUE(user_id, month, year) constraint
+
+    -- categories are stored normalized (see normalize_category), bring older rows in line
+    -- so equality filters still find them
+    UPDATE expenses SET category = LOWER(TRIM(category)) WHERE category <> LOWER(TRIM(category));
+    UPDATE recurring_expenses SET category = LOWER(TRIM(category)) WHERE category <> LOWER(TRIM(category));
+
+    -- aggregations run in postgres so only one row per category / month crosses the wire
+    CREATE OR REPLACE FUNCTION expense_totals_by_category(uid INTEGER)
+    RETURNS TABLE(category TEXT, total FLOAT) LANGUAGE sql STABLE AS $$
+        SELECT e.category, SUM(e.amount) FROM expenses e
+        WHERE e.user_id = uid GROUP BY e.category ORDER BY 2 DESC
+    $$;
+
+    CREATE OR REPLACE FUNCTION monthly_category_totals(uid INTEGER, since FLOAT, until FLOAT)
+    RETURNS TABLE(category TEXT, total FLOAT, n BIGINT) LANGUAGE sql STABLE AS $$
+        SELECT e.category, SUM(e.amount), COUNT(*) FROM expenses e
+        WHERE e.user_id = uid AND e.timestamp >= since AND e.timestamp < until
+        GROUP BY e.category ORDER BY 2 DESC
+    $$;
+
+    CREATE OR REPLACE FUNCTION monthly_totals(uid INTEGER, since FLOAT)
+    RETURNS TABLE(month TEXT, total FLOAT) LANGUAGE sql STABLE AS $$
+        SELECT LEFT(e.date, 7), SUM(e.amount) FROM expenses e
+        WHERE e.user_id = uid AND e.timestamp >= since GROUP BY 1 ORDER BY 1
+    $$;
     """
-    res = requests.post(
+    # the project url is hashed in too, pointing .env at another (or a freshly reset) project
+    # on the same machine must not skip creating its tables
+    digest = hashlib.sha256(f"{SUPABASE_URL}\n{sql}".encode()).hexdigest()
+    if SCHEMA_SENTINEL.exists() and SCHEMA_SENTINEL.read_text() == digest:
+        logger.info("Schema unchanged since last init, skipping table setup")
+        return
+
+    # runs once at import, before the event loop exists, so this one stays synchronous
+    res = httpx.post(
         f"{SUPABASE_URL}/rest/v1/rpc/exec_sql",
         headers=HEADERS,
-        json={"query": sql}
+        json={"query": sql},
+        timeout=REQUEST_TIMEOUT
     )
 
-    # try the pg endpoint directly if the rpc call didn't work
-    if not res.ok:
-        res = requests.post(
-            f"{SUPABASE_URL}/pg/query",
-            headers={**HEADERS, "Content-Type": "application/json"},
-            json={"query": sql}
-        )
-
-    if res.ok:
+    if res.is_success:
         logger.info("Tables initialized successfully")
+        SCHEMA_SENTINEL.write_text(digest)
+    elif res.status_code == 404 and "PGRST202" in res.text:
+        # PGRST202 = postgrest couldn't find the function, nothing else to try
+        logger.warning("exec_sql isn't defined, create it in the Supabase SQL Editor with "
+                       "CREATE FUNCTION exec_sql(query text) RETURNS void LANGUAGE plpgsql "
+                       "AS $$ BEGIN EXECUTE query; END $$; or create the tables manually")
     else:
         logger.warning(f"Table init response: {res.status_code} - {res.text}")
         logger.warning("If tables do not exist, please create them manually in Supabase SQL Editor")
 
 
-init_tables()
+if RUN_MIGRATIONS:
+    init_tables()
 
 
 # Supabase Helpers
-# thin wrappers so we don't repeat requests boilerplate everywhere
+# thin wrappers so we don't repeat httpx boilerplate everywhere
+# auth headers live on CLIENT, per-call headers only override Prefer
 # all functions return empty list / empty dict on failure instead of raising
 
-def sb_get(table: str, params: dict = {}) -> list:
-    res = requests.get(f"{SUPABASE_URL}/rest/v1/{table}", headers=HEADERS, params=params)
-    return res.json() if res.ok else []
-
-def sb_post(table: str, data: dict) -> dict:
-    res = requests.post(f"{SUPABASE_URL}/rest/v1/{table}", headers=HEADERS, json=data)
-    result = res.json()
+def should_retry(method: str, status: int) -> bool:
+    if status == RATE_LIMIT_STATUS:
+        return True
+    return method in RETRY_METHODS and status in RETRY_STATUSES
+
+async def sb_request(method: str, path: str, payload=None, **kwargs) -> httpx.Response:
+    # single choke point for supabase calls so the retry policy lives in one place
+    # bodies are encoded with orjson up front instead of letting httpx use stdlib json
+    if payload is not None:
+        kwargs["content"] = orjson.dumps(payload)
+    for attempt in range(MAX_RETRIES + 1):
+        res = await CLIENT.request(method, path, **kwargs)
+        if attempt == MAX_RETRIES or not should_retry(method, res.status_code):
+            return res
+        delay = RETRY_BACKOFF * 2 ** attempt
+        # respect the server's Retry-After on rate limits when it sends one in seconds,
+        # but if it's asking for longer than we're willing to wait just hand back the 429
+        retry_after = res.headers.get("retry-after", "")
+        if res.status_code == RATE_LIMIT_STATUS and retry_after.isdigit():
+            if int(retry_after) > MAX_RETRY_DELAY:
+                return res
+            delay = max(delay, int(retry_after))
+        await asyncio.sleep(delay)
+
+def sb_json(res: httpx.Response):
+    return orjson.loads(res.content)
+
+async def sb_get(table: str, params: dict = {}) -> list:
+    res = await sb_request("GET", f"/{table}", params=params)
+    return sb_json(res) if res.is_success else []
+
+# writes only echo back the columns in `select`, callers just check for "id",
+# so by default we don't pay to ship e.g. a whole chat message back from supabase
+
+async def sb_post(table: str, data: dict | list, select: str = "id") -> dict | list:
+    # pass a list of rows to insert them all in one request (postgrest does it atomically),
+    # the inserted rows come back as a list in that case
+    res = await sb_request("POST", f"/{table}", params={"select": select}, payload=data)
+    result = sb_json(res)
+    if isinstance(data, list):
+        return result
     # supabase returns a list even for single inserts, so unwrap it
     return result[0] if isinstance(result, list) and result else result
 
-def sb_patch(table: str, params: dict, data: dict) -> dict:
-    res = requests.patch(f"{SUPABASE_URL}/rest/v1/{table}", headers=HEADERS, params=params, json=data)
-    result = res.json()
+async def sb_patch(table: str, params: dict, data: dict, select: str = "id") -> dict:
+    res = await sb_request("PATCH", f"/{table}", params={**params, "select": select}, payload=data)
+    result = sb_json(res)
     return result[0] if isinstance(result, list) and result else result
 
-def sb_delete(table: str, params: dict) -> int:
+async def sb_delete(table: str, params: dict) -> int:
     # need count=exact in Prefer header to get back how many rows were deleted
-    h = {**HEADERS, "Prefer": "count=exact"}
-    res = requests.delete(f"{SUPABASE_URL}/rest/v1/{table}", headers=h, params=params)
+    res = await sb_request("DELETE", f"/{table}", headers={"Prefer": "count=exact"}, params=params)
     count = res.headers.get("content-range", "0")
-    return int(count.split("/")[-1]) if "/" in count else (1 if res.ok else 0)
+    return int(count.split("/")[-1]) if "/" in count else (1 if res.is_success else 0)
 
-def sb_upsert(table: str, data: dict, on_conflict: str) -> dict:
+async def sb_upsert(table: str, data: dict, on_conflict: str) -> bool:
     # merge-duplicates means update on conflict rather than error
-    h = {**HEADERS, "Prefer": "resolution=merge-duplicates,return=representation"}
-    res = requests.post(f"{SUPABASE_URL}/rest/v1/{table}?on_conflict={on_conflict}", headers=h, json=data)
-    result = res.json()
-    return result[0] if isinstance(result, list) and result else result
-
-def auth(username: str, password: str):
-    # returns the user row or None — called at the top of every tool that needs a logged-in user
-    rows = sb_get("users", {"username": f"eq.{username.strip().lower()}", "password": f"eq.{password}"})
-    return rows[0] if rows else None
+    # return=minimal since nobody reads the row back, supabase sends an empty 201/204
+    h = {"Prefer": "resolution=merge-duplicates,return=minimal"}
+    res = await sb_request("POST", f"/{table}", headers=h, params={"on_conflict": on_conflict}, payload=data)
+    return res.is_success
+
+async def sb_rpc(function: str, args: dict) -> Optional[list]:
+    # call a postgres function created in init_tables
+    # returns None (not []) when the call fails, e.g. the function was never installed,
+    # so callers can tell "no rows" apart from "fall back to doing it in python"
+    res = await sb_request("POST", f"/rpc/{function}", payload=args)
+    return sb_json(res) if res.is_success else None
+
+# bcrypt only looks at the first 72 bytes, and bcrypt>=5 raises ValueError past that
+MAX_PASSWORD_BYTES = 72
+
+def hash_password(password: str) -> str:
+    # bcrypt hash, this is what goes in users.password
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+def check_password(password: str, stored: str) -> bool:
+    # accounts created before hashing was added still hold the plaintext password
+    if not stored.startswith("$2"):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    # too long to ever have been registered, so it can't match (and bcrypt would raise)
+    if len(password.encode()) > MAX_PASSWORD_BYTES:
+        return False
+    return bcrypt.checkpw(password.encode(), stored.encode())
+
+# recently verified credentials -> {"id", "name", "username"}
+# saves the bcrypt check (and for write tools the whole users lookup) on back-to-back tool calls
+# 5 minutes covers a typical chat session, change_password evicts the old entry right away
+# keyed by a sha256 of the password so the plaintext never sits in memory longer than the call
+# only ever touched from the event loop thread, so it needs no lock
+AUTH_CACHE = TTLCache(maxsize=1024, ttl=300)
+
+def auth_cache_key(username: str, password: str) -> tuple[str, str]:
+    return username.strip().lower(), hashlib.sha256(password.encode()).hexdigest()
+
+INVALID_LOGIN = "Invalid username or password"
+
+async def auth(username: str, password: str) -> tuple[Optional[dict], Optional[str]]:
+    # returns (user row, None) or (None, error string) — called at the top of every tool that
+    # needs a logged-in user, the error tells bad credentials apart from supabase being down
+    return await auth_with(username, password)
+
+async def auth_with(username: str, password: str, embed: str = "", params: dict = {}) -> tuple[Optional[dict], Optional[str]]:
+    # same as auth() but pulls the user's related rows in the same request via a postgrest
+    # embedded resource, e.g. embed="expenses(id,amount)" with params={"expenses.order": ...}
+    # read-only tools use this so credentials + data cost one round trip instead of two
+    # the lookup is by username only, the password never goes into the url
+    key = auth_cache_key(username, password)
+    cached = AUTH_CACHE.get(key)
+    if cached and not embed:
+        return dict(cached), None
+
+    # on a cache hit we still need the embedded rows, but not the hash or the check
+    query = {
+        "username": f"eq.{key[0]}",
+        "select": "id,name,username" + ("" if cached else ",password") + (f",{embed}" if embed else ""),
+        **params,
+    }
+    # not sb_get, a failed query (bad embed params, supabase down) must not look like a wrong password
+    res = await sb_request("GET", "/users", params=query)
+    if not res.is_success:
+        logger.warning(f"User lookup failed: {res.status_code} - {res.text}")
+        return None, f"Database request failed ({res.status_code}), please try again"
+    rows = sb_json(res)
+    if not rows:
+        return None, INVALID_LOGIN
+
+    user = rows[0]
+    if not cached:
+        stored = user.pop("password")
+        # bcrypt is deliberately slow, run it off the event loop
+        if not await asyncio.to_thread(check_password, password, stored):
+            return None, INVALID_LOGIN
+        if not stored.startswith("$2") and len(password.encode()) <= MAX_PASSWORD_BYTES:
+            # upgrade a legacy plaintext password to a hash the first time it's used
+            # (one too long for bcrypt stays as is until the user changes it)
+            hashed = await asyncio.to_thread(hash_password, password)
+            await sb_patch("users", {"id": f"eq.{user['id']}"}, {"password": hashed})
+        AUTH_CACHE[key] = {"id": user["id"], "name": user["name"], "username": user["username"]}
+    return user, None
 
 
 # Input Validation
 # small helpers to keep the tool functions clean, return an error string or None
 
 def validate_amount(amount: float) -> Optional[str]:
-    if amount <= 0:
-        return "Amount must be greater than zero"
+    # checked after rounding to cents, otherwise something like 0.004 passes and gets stored as 0.00
+    if normalize_amount(amount) <= 0:
+        return "Amount must be at least $0.01"
+    return None
+
+def validate_password(password: str) -> Optional[str]:
+    if len(password) < 6:
+        return "Password must be at least 6 characters"
+    if len(password.encode()) > MAX_PASSWORD_BYTES:
+        return f"Password can't be longer than {MAX_PASSWORD_BYTES} bytes"
     return None
 
 def validate_category(category: str) -> Optional[str]:
@@ -161,47 +362,88 @@ def validate_category(category: str) -> Optional[str]:
         return "Category cannot be empty"
     return None
 
+def normalize_amount(amount: float) -> float:
+    # amounts are money, keep them at whole cents so stored values and sums don't drift
+    # (e.g. 0.1 + 0.2) and every row round-trips as a short decimal
+    return round(amount, 2)
+
+def normalize_category(category: str) -> str:
+    # categories are stored lowercase so lookups can be plain equality (index-friendly)
+    # instead of a case-insensitive ilike that has to scan
+    return category.strip().lower()
+
 def validate_day_of_month(day: int) -> Optional[str]:
     if not (1 <= day <= 31):
         return "day_of_month must be between 1 and 31"
     return None
 
+def validate_month_year(month: int, year: int) -> Optional[str]:
+    # month_bounds builds datetimes from these, so anything out of range would raise there
+    if not (1 <= month <= 12):
+        return "month must be between 1 and 12"
+    if not (1970 <= year <= 2100):
+        return "year must be between 1970 and 2100"
+    return None
+
+
+# Date Helpers
+
+def month_bounds(month: int, year: int) -> tuple[float, float]:
+    # half-open [start, end) timestamp range for a calendar month
+    # filtering on the numeric timestamp lets postgres use the (user_id, timestamp) index,
+    # a LIKE on the text date column can't
+    start = datetime(year, month, 1)
+    end = datetime(year + (month == 12), month % 12 + 1, 1)
+    return start.timestamp(), end.timestamp()
+
+def months_ago_start(n: int) -> float:
+    # timestamp of the first day of the month n months before the current one
+    now = datetime.now()
+    month, year = now.month - n, now.year
+    if month < 1:
+        month, year = month + 12, year - 1
+    return month_bounds(month, year)[0]
+
+@lru_cache(maxsize=4096)
+def display_date(iso: str) -> str:
+    # rows come back with microsecond iso dates but we only show minutes,
+    # so callers pass iso[:16] and rows from the same minute hit the cache
+    return datetime.fromisoformat(iso).strftime(DISPLAY_DATE_FMT)
+
 
 # Auth Tools
 
 @mcp.tool()
-def register_user(name: str, username: str, password: str) -> str:
+async def register_user(name: str, username: str, password: str) -> str:
     """Register a new user with name, username and password"""
     if not name.strip():
         return "Name cannot be empty"
     if not username.strip():
         return "Username cannot be empty"
-    if len(password) < 6:
-        return "Password must be at least 6 characters"
-
-    # make sure username isn't already taken before inserting
-    existing = sb_get("users", {"username": f"eq.{username.strip().lower()}"})
-    if existing:
-        return f"Username '{username}' is already taken"
+    if err := validate_password(password): return err
 
-    result = sb_post("users", {
+    # no separate "is it taken" lookup, the UNIQUE constraint on username does the check
+    # as part of the insert and postgres reports a clash as 23505 (unique_violation)
+    result = await sb_post("users", {
         "name": name.strip(),
         "username": username.strip().lower(),  # always store lowercase
-        "password": password
+        "password": await asyncio.to_thread(hash_password, password)
     })
 
     if "id" in result:
         logger.info(f"New user registered: '{username}'")
         return f"Welcome, {name}! Your account has been created. You can now login with username '{username.strip().lower()}'"
+    if isinstance(result, dict) and result.get("code") == "23505":
+        return f"Username '{username}' is already taken"
     return f"Registration failed: {result}"
 
 
 @mcp.tool()
-def login_user(username: str, password: str) -> str:
+async def login_user(username: str, password: str) -> str:
     """Login with username and password"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
     logger.info(f"User '{username}' logged in")
     # return enough info so the frontend can populate session state
     return (
@@ -213,34 +455,38 @@ def login_user(username: str, password: str) -> str:
 
 
 @mcp.tool()
-def change_password(username: str, old_password: str, new_password: str) -> str:
+async def change_password(username: str, old_password: str, new_password: str) -> str:
     """Change password for a user"""
-    # auth with old password first to confirm identity
-    user = auth(username, old_password)
-    if not user:
-        return "Invalid username or old password"
-    if len(new_password) < 6:
-        return "New password must be at least 6 characters"
-    sb_patch("users", {"username": f"eq.{username.strip().lower()}"}, {"password": new_password})
+    if err := validate_password(new_password): return err
+    # auth with old password to confirm identity
+    user, err = await auth(username, old_password)
+    if err:
+        # keep pointing at the old password, that's the one being checked here
+        return "Invalid username or old password" if err == INVALID_LOGIN else err
+    hashed = await asyncio.to_thread(hash_password, new_password)
+    await sb_patch("users", {"username": f"eq.{username.strip().lower()}"}, {"password": hashed})
+    # the old password must stop working straight away, not when the cache entry expires
+    AUTH_CACHE.pop(auth_cache_key(username, old_password), None)
     return "Password changed successfully"
 
 
 # Expense Tools
 
 @mcp.tool()
-def add_expense(username: str, password: str, amount: float, category: str, description: str = "") -> str:
+async def add_expense(username: str, password: str, amount: float, category: str, description: str = "") -> str:
     """Add a new expense (requires login credentials)"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
     if err := validate_amount(amount): return err
     if err := validate_category(category): return err
 
+    user, err = await auth(username, password)
+    if err:
+        return err
+
     now = datetime.now()
-    sb_post("expenses", {
+    await sb_post("expenses", {
         "user_id": user["id"],
-        "amount": amount,
-        "category": category.strip(),
+        "amount": normalize_amount(amount),
+        "category": normalize_category(category),
         "description": description,
         "date": now.isoformat(),
         "timestamp": now.timestamp()  # float timestamp for easy sorting
@@ -251,267 +497,306 @@ def add_expense(username: str, password: str, amount: float, category: str, desc
 
 
 @mcp.tool()
-def get_expenses(username: str, password: str, category: str = None, limit: int = 10) -> str:
+async def get_expenses(username: str, password: str, category: str = None, limit: int = 10) -> str:
     """Get recent expenses (requires login credentials)"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
-    params = {"user_id": f"eq.{user['id']}", "order": "timestamp.desc", "limit": str(limit)}
+    # the limit goes straight into the embed params, and postgrest rejects a bad one outright
+    limit = max(1, min(limit, 200))
+    params = {"expenses.order": "timestamp.desc", "expenses.limit": str(limit)}
     if category:
-        # ilike for case-insensitive category matching
-        params["category"] = f"ilike.{category}"
+        params["expenses.category"] = f"eq.{normalize_category(category)}"
 
-    rows = sb_get("expenses", params)
+    user, err = await auth_with(username, password, "expenses(id,amount,category,description,date)", params)
+    if err:
+        return err
+
+    rows = user["expenses"]
     if not rows:
         return "No expenses found"
 
-    result = f"Recent Expenses for '{user['name']}' ({len(rows)} shown):\n\n"
+    parts = [f"Recent Expenses for '{user['name']}' ({len(rows)} shown):\n\n"]
     for row in rows:
-        date = datetime.fromisoformat(row["date"]).strftime("%Y-%m-%d %H:%M")
-        result += f"- [#{row['id']}] ${row['amount']:.2f} - {row['category']} - {date}\n"
+        date = display_date(row["date"][:16])
+        parts.append(f"- [#{row['id']}] ${row['amount']:.2f} - {row['category']} - {date}\n")
         if row.get("description"):
-            result += f"  Description: {row['description']}\n"
-    return result
+            parts.append(f"  Description: {row['description']}\n")
+    return "".join(parts)
 
 
 @mcp.tool()
-def get_total_by_category(username: str, password: str) -> str:
+async def get_total_by_category(username: str, password: str) -> str:
     """Get total expenses grouped by category"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
 
-    # grab all expenses and group them in python, supabase free tier doesn't support group-by via rest
-    rows = sb_get("expenses", {"user_id": f"eq.{user['id']}"})
-    if not rows:
-        return "No expenses recorded yet"
+    totals = await sb_rpc("expense_totals_by_category", {"uid": user["id"]})
+    if totals is not None:
+        category_totals = {row["category"]: row["total"] for row in totals}
+    else:
+        # rpc not installed, grab the raw rows and group them in python instead
+        category_totals = defaultdict(float)
+        for row in await sb_get("expenses", {"user_id": f"eq.{user['id']}", "select": "category,amount"}):
+            category_totals[row["category"]] += row["amount"]
 
-    category_totals = {}
-    for row in rows:
-        category_totals[row["category"]] = category_totals.get(row["category"], 0) + row["amount"]
+    if not category_totals:
+        return "No expenses recorded yet"
 
-    result = f"Total Expenses by Category for '{user['name']}':\n\n"
+    parts = [f"Total Expenses by Category for '{user['name']}':\n\n"]
     grand_total = 0
     for cat, amt in sorted(category_totals.items(), key=lambda x: x[1], reverse=True):
-        result += f"- {cat}: ${amt:.2f}\n"
+        parts.append(f"- {cat}: ${amt:.2f}\n")
         grand_total += amt
-    result += f"\nGrand Total: ${grand_total:.2f}"
-    return result
+    parts.append(f"\nGrand Total: ${grand_total:.2f}")
+    return "".join(parts)
 
 
 @mcp.tool()
-def delete_expense(username: str, password: str, expense_id: int) -> str:
+async def delete_expense(username: str, password: str, expense_id: int) -> str:
     """Delete an expense by ID"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
 
     # filter by user_id too so users can't delete each other's expenses
-    count = sb_delete("expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"})
+    count = await sb_delete("expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"})
     if count > 0:
         return f"Expense #{expense_id} deleted successfully"
     return f"Expense #{expense_id} not found or does not belong to you"
 
 
 @mcp.tool()
-def update_expense(username: str, password: str, expense_id: int, amount: float = None, category: str = None, description: str = None) -> str:
+async def update_expense(username: str, password: str, expense_id: int, amount: float = None, category: str = None, description: str = None) -> str:
     """Update an existing expense"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     # only validate fields that were actually passed in
     if amount is not None:
         if err := validate_amount(amount): return err
     if category is not None:
         if err := validate_category(category): return err
 
-    existing = sb_get("expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"})
-    if not existing:
-        return f"Expense #{expense_id} not found or does not belong to you"
-
     # build the update dict dynamically so we don't overwrite fields with None
     updates = {}
-    if amount is not None: updates["amount"] = amount
-    if category is not None: updates["category"] = category.strip()
+    if amount is not None: updates["amount"] = normalize_amount(amount)
+    if category is not None: updates["category"] = normalize_category(category)
     if description is not None: updates["description"] = description
 
-    if updates:
-        sb_patch("expenses", {"id": f"eq.{expense_id}"}, updates)
+    # a no-op call never needs to touch supabase, not even for auth
+    if not updates:
+        return f"Nothing to update for expense #{expense_id}"
+
+    user, err = await auth(username, password)
+    if err:
+        return err
+
+    # filter on user_id too so the patch itself is the ownership check,
+    # no row comes back if the expense doesn't exist or isn't theirs
+    result = await sb_patch("expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"}, updates)
+    if "id" not in result:
+        return f"Expense #{expense_id} not found or does not belong to you"
     return f"Expense #{expense_id} updated successfully"
 
 
 @mcp.tool()
-def get_monthly_summary(username: str, password: str, month: int = None, year: int = None) -> str:
+async def get_monthly_summary(username: str, password: str, month: int = None, year: int = None) -> str:
     """Get expense summary for a specific month"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     # default to current month/year if not specified
     now = datetime.now()
     month = month or now.month
     year = year or now.year
-    prefix = f"{year}-{str(month).zfill(2)}"
+    if err := validate_month_year(month, year): return err
+    start_ts, end_ts = month_bounds(month, year)
 
-    # filter by date prefix string since we store dates as isoformat text
-    rows = sb_get("expenses", {"user_id": f"eq.{user['id']}", "date": f"like.{prefix}%"})
-    if not rows:
-        return f"No expenses found for {month}/{year}"
+    user, err = await auth(username, password)
+    if err:
+        return err
 
-    total = sum(r["amount"] for r in rows)
-    category_totals = {}
-    for row in rows:
-        category_totals[row["category"]] = category_totals.get(row["category"], 0) + row["amount"]
+    totals = await sb_rpc("monthly_category_totals", {"uid": user["id"], "since": start_ts, "until": end_ts})
+    if totals is not None:
+        category_totals = {row["category"]: row["total"] for row in totals}
+        count = sum(row["n"] for row in totals)
+    else:
+        # rpc not installed, fetch the month's rows and group them in python
+        # list value -> repeated query param, postgrest ANDs the two filters
+        rows = await sb_get("expenses", {
+            "user_id": f"eq.{user['id']}",
+            "timestamp": [f"gte.{start_ts}", f"lt.{end_ts}"],
+            "select": "category,amount",
+        })
+        category_totals = defaultdict(float)
+        for row in rows:
+            category_totals[row["category"]] += row["amount"]
+        count = len(rows)
+
+    if not category_totals:
+        return f"No expenses found for {month}/{year}"
 
-    result = f"Summary for '{user['name']}' - {month}/{year}:\n\n"
-    result += f"Total Expenses: ${total:.2f}\nNumber of Transactions: {len(rows)}\n\nBy Category:\n"
+    total = sum(category_totals.values())
+    parts = [
+        f"Summary for '{user['name']}' - {month}/{year}:\n\n",
+        f"Total Expenses: ${total:.2f}\nNumber of Transactions: {count}\n\nBy Category:\n",
+    ]
     for cat, amt in sorted(category_totals.items(), key=lambda x: x[1], reverse=True):
-        result += f"- {cat}: ${amt:.2f} ({(amt/total)*100:.1f}%)\n"
-    return result
+        parts.append(f"- {cat}: ${amt:.2f} ({(amt/total)*100:.1f}%)\n")
+    return "".join(parts)
 
 
 # Budget Tools
 
 @mcp.tool()
-def set_budget(username: str, password: str, amount: float, month: int = None, year: int = None) -> str:
+async def set_budget(username: str, password: str, amount: float, month: int = None, year: int = None) -> str:
     """Set a monthly budget"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if err := validate_amount(amount): return err
 
     # default to current month/year if not passed
     now = datetime.now()
     month = month or now.month
     year = year or now.year
+    if err := validate_month_year(month, year): return err
+
+    user, err = await auth(username, password)
+    if err:
+        return err
 
     # upsert so calling this twice just updates the budget instead of erroring
-    sb_upsert("budgets", {"user_id": user["id"], "month": month, "year": year, "amount": amount}, "user_id,month,year")
+    if not await sb_upsert("budgets", {"user_id": user["id"], "month": month, "year": year, "amount": normalize_amount(amount)}, "user_id,month,year"):
+        return f"Failed to set budget for {month}/{year}"
     return f"Budget set to ${amount:.2f} for {month}/{year}"
 
 
 @mcp.tool()
-def check_budget_status(username: str, password: str, month: int = None, year: int = None) -> str:
+async def check_budget_status(username: str, password: str, month: int = None, year: int = None) -> str:
     """Check budget status"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     now = datetime.now()
     month = month or now.month
     year = year or now.year
+    if err := validate_month_year(month, year): return err
+    start_ts, end_ts = month_bounds(month, year)
+
+    # credentials, the month's budget and the month's expenses all in one request
+    user, err = await auth_with(username, password, "budgets(amount),expenses(amount)", {
+        "budgets.month": f"eq.{month}",
+        "budgets.year": f"eq.{year}",
+        "expenses.timestamp": [f"gte.{start_ts}", f"lt.{end_ts}"],
+    })
+    if err:
+        return err
 
-    budget_rows = sb_get("budgets", {"user_id": f"eq.{user['id']}", "month": f"eq.{month}", "year": f"eq.{year}"})
-    if not budget_rows:
+    if not user["budgets"]:
         return f"No budget set for {month}/{year}. Use set_budget to create one."
 
-    budget = budget_rows[0]["amount"]
-    prefix = f"{year}-{str(month).zfill(2)}"
-    expense_rows = sb_get("expenses", {"user_id": f"eq.{user['id']}", "date": f"like.{prefix}%"})
-    spent = sum(r["amount"] for r in expense_rows)
+    budget = user["budgets"][0]["amount"]
+    spent = sum(r["amount"] for r in user["expenses"])
+
+    # rows saved before amounts were validated on whole cents can hold a 0.00 budget
+    if budget <= 0:
+        return f"The budget for {month}/{year} is $0.00. Use set_budget to set a real amount."
 
     remaining = budget - spent
     pct_used = (spent / budget) * 100
 
-    result = f"Budget Status for '{user['name']}' - {month}/{year}:\n\n"
-    result += f"Budget:    ${budget:.2f}\nSpent:     ${spent:.2f} ({pct_used:.1f}%)\nRemaining: ${remaining:.2f}\n"
-
     # give the user a heads up if they're getting close or have gone over
     if spent > budget:
-        result += "\nWARNING: You have EXCEEDED your budget!"
+        status = "WARNING: You have EXCEEDED your budget!"
     elif pct_used >= 80:
-        result += "\nWARNING: You have used over 80% of your budget!"
+        status = "WARNING: You have used over 80% of your budget!"
     else:
-        result += "\nYou are within your budget."
-    return result
+        status = "You are within your budget."
+
+    return (
+        f"Budget Status for '{user['name']}' - {month}/{year}:\n\n"
+        f"Budget:    ${budget:.2f}\nSpent:     ${spent:.2f} ({pct_used:.1f}%)\nRemaining: ${remaining:.2f}\n"
+        f"\n{status}"
+    )
 
 
 # Spending Trend
 
 @mcp.tool()
-def get_spending_trend(username: str, password: str) -> str:
+async def get_spending_trend(username: str, password: str) -> str:
     """Get spending totals for the last 6 months"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
+
+    # only the current month and the 5 before it are ever shown, so only those rows are read
+    since = months_ago_start(5)
+    totals = await sb_rpc("monthly_totals", {"uid": user["id"], "since": since})
+    if totals is not None:
+        monthly = {row["month"]: row["total"] for row in totals}
+    else:
+        # rpc not installed, group by year-month string (e.g. "2024-03") in python
+        monthly = defaultdict(float)
+        params = {"user_id": f"eq.{user['id']}", "timestamp": f"gte.{since}", "select": "date,amount"}
+        for row in await sb_get("expenses", params):
+            monthly[row["date"][:7]] += row["amount"]
 
-    rows = sb_get("expenses", {"user_id": f"eq.{user['id']}", "order": "date.desc"})
-    if not rows:
+    if not monthly:
         return "No spending data found"
 
-    # group by year-month string (e.g. "2024-03")
-    monthly = {}
-    for row in rows:
-        key = row["date"][:7]
-        monthly[key] = monthly.get(key, 0) + row["amount"]
-
-    # take only the 6 most recent months and flip to chronological order for the chart
-    sorted_months = sorted(monthly.keys(), reverse=True)[:6]
-    sorted_months = list(reversed(sorted_months))
+    # the timestamp window already limits this to 6 months, just put them in chronological order
+    sorted_months = sorted(monthly)
 
     # scale the bar chart relative to the highest-spending month
     max_total = max(monthly[m] for m in sorted_months)
-    result = f"Spending Trend for '{user['name']}' (Last 6 Months):\n\n"
+    parts = [f"Spending Trend for '{user['name']}' (Last 6 Months):\n\n"]
     for m in sorted_months:
         bar = "#" * int((monthly[m] / max_total) * 20)
-        result += f"{m}  {bar}  ${monthly[m]:.2f}\n"
-    return result
+        parts.append(f"{m}  {bar}  ${monthly[m]:.2f}\n")
+    return "".join(parts)
 
 
 # Recurring Expenses
 
 @mcp.tool()
-def add_recurring_expense(username: str, password: str, amount: float, category: str, day_of_month: int, description: str = "") -> str:
+async def add_recurring_expense(username: str, password: str, amount: float, category: str, day_of_month: int, description: str = "") -> str:
     """Register a recurring monthly expense"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if err := validate_amount(amount): return err
     if err := validate_category(category): return err
     if err := validate_day_of_month(day_of_month): return err
 
-    sb_post("recurring_expenses", {
-        "user_id": user["id"], "amount": amount,
-        "category": category.strip(), "description": description,
+    user, err = await auth(username, password)
+    if err:
+        return err
+
+    await sb_post("recurring_expenses", {
+        "user_id": user["id"], "amount": normalize_amount(amount),
+        "category": normalize_category(category), "description": description,
         "day_of_month": day_of_month
     })
     return f"Recurring expense added: ${amount:.2f} for {category} on day {day_of_month} of each month"
 
 
 @mcp.tool()
-def get_recurring_expenses(username: str, password: str) -> str:
+async def get_recurring_expenses(username: str, password: str) -> str:
     """List all recurring expenses"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     # order by day_of_month so it reads like a calendar
-    rows = sb_get("recurring_expenses", {"user_id": f"eq.{user['id']}", "order": "day_of_month.asc"})
+    user, err = await auth_with(username, password, "recurring_expenses(id,amount,category,description,day_of_month)", {
+        "recurring_expenses.order": "day_of_month.asc"
+    })
+    if err:
+        return err
+
+    rows = user["recurring_expenses"]
     if not rows:
         return "No recurring expenses found"
 
     total = sum(r["amount"] for r in rows)
-    result = f"Recurring Expenses for '{user['name']}':\n\n"
+    parts = [f"Recurring Expenses for '{user['name']}':\n\n"]
     for row in rows:
-        result += f"- [#{row['id']}] ${row['amount']:.2f} - {row['category']} - Every month on day {row['day_of_month']}\n"
+        parts.append(f"- [#{row['id']}] ${row['amount']:.2f} - {row['category']} - Every month on day {row['day_of_month']}\n")
         if row.get("description"):
-            result += f"  Description: {row['description']}\n"
-    result += f"\nTotal Monthly Recurring: ${total:.2f}"
-    return result
+            parts.append(f"  Description: {row['description']}\n")
+    parts.append(f"\nTotal Monthly Recurring: ${total:.2f}")
+    return "".join(parts)
 
 
 @mcp.tool()
-def delete_recurring_expense(username: str, password: str, expense_id: int) -> str:
+async def delete_recurring_expense(username: str, password: str, expense_id: int) -> str:
     """Delete a recurring expense by ID"""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
 
-    count = sb_delete("recurring_expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"})
+    count = await sb_delete("recurring_expenses", {"id": f"eq.{expense_id}", "user_id": f"eq.{user['id']}"})
     if count > 0:
         return f"Recurring expense #{expense_id} deleted"
     return f"Recurring expense #{expense_id} not found or does not belong to you"
@@ -520,22 +805,22 @@ def delete_recurring_expense(username: str, password: str, expense_id: int) -> s
 # Chat History Tools
 
 @mcp.tool()
-def save_chat_message(username: str, password: str, role: str, content: str) -> str:
+async def save_chat_message(username: str, password: str, role: str, content: str) -> str:
     """
     Save a single chat message to the user's history.
     role must be 'user' or 'assistant'.
     """
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if role not in ("user", "assistant"):
         return "role must be 'user' or 'assistant'"
     if not content.strip():
         return "content cannot be empty"
 
+    user, err = await auth(username, password)
+    if err:
+        return err
+
     now = datetime.now()
-    sb_post("chat_history", {
+    await sb_post("chat_history", {
         "user_id": user["id"],
         "role": role,
         "content": content.strip(),
@@ -546,117 +831,125 @@ def save_chat_message(username: str, password: str, role: str, content: str) ->
 
 
 @mcp.tool()
-def save_chat_exchange(username: str, password: str, user_message: str, assistant_message: str) -> str:
+async def save_chat_exchange(username: str, password: str, user_message: str, assistant_message: str) -> str:
     """
     Save a user + assistant message pair in one call (more efficient than two separate saves).
     Use this after every chat turn to persist the conversation.
     """
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if not user_message.strip() or not assistant_message.strip():
         return "Both user_message and assistant_message must be non-empty"
 
+    user, err = await auth(username, password)
+    if err:
+        return err
+
     now = datetime.now()
     ts = now.timestamp()
     date_str = now.isoformat()
 
-    # save both messages with the same timestamp base
-    sb_post("chat_history", {
-        "user_id": user["id"],
-        "role": "user",
-        "content": user_message.strip(),
-        "timestamp": ts,
-        "date": date_str
-    })
-    sb_post("chat_history", {
-        "user_id": user["id"],
-        "role": "assistant",
-        "content": assistant_message.strip(),
-        "timestamp": ts + 0.001,  # tiny offset so ordering stays deterministic
-        "date": date_str
-    })
+    # save both messages with the same timestamp base, as one bulk insert
+    rows = await sb_post("chat_history", [
+        {
+            "user_id": user["id"],
+            "role": "user",
+            "content": user_message.strip(),
+            "timestamp": ts,
+            "date": date_str
+        },
+        {
+            "user_id": user["id"],
+            "role": "assistant",
+            "content": assistant_message.strip(),
+            "timestamp": ts + 0.001,  # tiny offset so ordering stays deterministic
+            "date": date_str
+        },
+    ])
+    # sb_post hands back the error body on a failed insert, so check both rows actually came back
+    if not (isinstance(rows, list) and len(rows) == 2 and all("id" in r for r in rows)):
+        return f"Failed to save chat exchange: {rows}"
     return "Chat exchange saved"
 
 
 @mcp.tool()
-def get_chat_history(username: str, password: str, limit: int = 50) -> str:
+async def get_chat_history(username: str, password: str, limit: int = 50) -> str:
     """
     Retrieve the most recent chat messages for the user (up to `limit` messages).
     Returns messages in chronological order (oldest first).
     Use this on login to restore conversation context.
     """
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if limit < 1 or limit > 200:
         return "limit must be between 1 and 200"
 
     # fetch descending then reverse so we get oldest-first in the output
-    rows = sb_get("chat_history", {
-        "user_id": f"eq.{user['id']}",
-        "order": "timestamp.desc",
-        "limit": str(limit)
+    user, err = await auth_with(username, password, "chat_history(role,content,date)", {
+        "chat_history.order": "timestamp.desc",
+        "chat_history.limit": str(limit)
     })
+    if err:
+        return err
 
+    rows = user["chat_history"]
     if not rows:
         return "No chat history found"
 
-    rows = list(reversed(rows))  # flip to chronological order
-
-    result = f"Chat History for '{user['name']}' ({len(rows)} messages):\n\n"
-    for row in rows:
-        date = datetime.fromisoformat(row["date"]).strftime("%Y-%m-%d %H:%M")
+    parts = [f"Chat History for '{user['name']}' ({len(rows)} messages):\n\n"]
+    for row in reversed(rows):  # walk backwards for chronological order, no reversed copy
+        date = display_date(row["date"][:16])
         role_label = "You" if row["role"] == "user" else "Assistant"
-        result += f"[{date}] {role_label}: {row['content']}\n\n"
+        parts.append(f"[{date}] {role_label}: {row['content']}\n\n")
 
-    return result.strip()
+    return "".join(parts).rstrip()
 
 
 @mcp.tool()
-def get_chat_history_raw(username: str, password: str, limit: int = 50) -> str:
+async def get_chat_history_raw(username: str, password: str, limit: int = 50, offset: int = 0) -> str:
     """
     Retrieve chat history as a JSON string of message dicts
     [{"role": "user"|"assistant", "content": "..."}] in chronological order.
     Use this when rebuilding LangChain message objects on login.
+    offset skips that many of the newest messages, for paging back through older history.
     """
-    import json
-
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
-
     if limit < 1 or limit > 200:
         return "limit must be between 1 and 200"
+    if offset < 0:
+        return "offset can't be negative"
 
-    rows = sb_get("chat_history", {
-        "user_id": f"eq.{user['id']}",
-        "order": "timestamp.desc",
-        "limit": str(limit)
+    user, err = await auth_with(username, password, "chat_history(role,content)", {
+        "chat_history.order": "timestamp.desc",
+        "chat_history.limit": str(limit),
+        "chat_history.offset": str(offset)
     })
+    if err:
+        return err
+
+    rows = user["chat_history"]
 
     # return empty JSON array instead of an error string so callers can json.loads() safely
     if not rows:
         return "[]"
 
-    rows = list(reversed(rows))  # chronological order
-    messages = [{"role": r["role"], "content": r["content"]} for r in rows]
-    return json.dumps(messages)
+    # chronological order
+    messages = [{"role": r["role"], "content": r["content"]} for r in reversed(rows)]
+    return orjson.dumps(messages).decode()
 
 
 @mcp.tool()
-def clear_chat_history(username: str, password: str) -> str:
+async def clear_chat_history(username: str, password: str) -> str:
     """Delete all chat history for the user."""
-    user = auth(username, password)
-    if not user:
-        return "Invalid username or password"
+    user, err = await auth(username, password)
+    if err:
+        return err
 
-    sb_delete("chat_history", {"user_id": f"eq.{user['id']}"})
+    await sb_delete("chat_history", {"user_id": f"eq.{user['id']}"})
     return "Chat history cleared"
 
 
 # Run Server
 if __name__ == "__main__":
+    # uvloop is a faster drop-in event loop, not available on windows so it's optional
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     mcp.run(transport='http', host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -2,11 +2,13 @@
 # core agent logic — handles MCP tool loading, auth, chat history, and the langgraph agent loop
 
 import os
-import json
+import hashlib
 import logging
 from typing import Annotated, TypedDict, Sequence, Any, Optional
 
+import orjson
 import pydantic
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
 from langchain_mcp_adapters.client import MultiServerMCPClient
@@ -37,14 +39,36 @@ SERVERS = {
 }
 
 
+# the tool list only changes when the server is redeployed, so it's fetched once and
+# reused for a while instead of a list_tools round trip on every login/save/chat turn
+# (each tool opens its own session when called, so a cached list holds no connections)
+TOOLS_TTL = 600
+TOOLS_CACHE = TTLCache(maxsize=1, ttl=TOOLS_TTL)
+
+# compiled agent per logged-in user, credentials are baked into the wrapped tools
+# so the key includes a hash of the password — a password change gets a fresh app
+# apps hold the tool objects they were built with, so they expire on the same clock as
+# the tool list or a redeployed server's tools would never reach existing users
+# neither cache needs a lock: the UI runs every call on its one persistent event loop thread
+APP_CACHE = TTLCache(maxsize=128, ttl=TOOLS_TTL)
+
+
+async def _load_tools() -> tuple[list, dict]:
+    # the list feeds the agent, the by-name dict serves the direct UI calls below
+    cached = TOOLS_CACHE.get("tools")
+    if cached is None:
+        client = MultiServerMCPClient(SERVERS)
+        tools = await client.get_tools()
+        cached = TOOLS_CACHE["tools"] = (tools, {t.name: t for t in tools})
+    return cached
+
+
 async def get_mcp_tools() -> list:
-    # fresh client every time — keeps things simple and avoids stale connections
-    client = MultiServerMCPClient(SERVERS)
-    return await client.get_tools()
+    return (await _load_tools())[0]
 
 
-def _find_tool(tools: list, name: str):
-    return next((t for t in tools if t.name == name), None)
+async def _find_tool(name: str):
+    return (await _load_tools())[1].get(name)
 
 
 def _extract_mcp_result(result) -> str:
@@ -66,8 +90,7 @@ def _extract_mcp_result(result) -> str:
 # not exposed to the LLM as agent tools
 
 async def mcp_register(name: str, username: str, password: str) -> str:
-    tools = await get_mcp_tools()
-    tool = _find_tool(tools, "register_user")
+    tool = await _find_tool("register_user")
     if not tool:
         return "Registration tool not available"
     result = await tool.coroutine(name=name, username=username, password=password)
@@ -75,40 +98,47 @@ async def mcp_register(name: str, username: str, password: str) -> str:
 
 
 async def mcp_login(username: str, password: str) -> str:
-    tools = await get_mcp_tools()
-    tool = _find_tool(tools, "login_user")
+    tool = await _find_tool("login_user")
     if not tool:
         return "Login tool not available"
     result = await tool.coroutine(username=username, password=password)
     return _extract_mcp_result(result)
 
 
+async def mcp_login_with_history(username: str, password: str, limit: int = 100) -> tuple[str, list[dict]]:
+    # login, then the first history page, as two server calls one after the other — the UI just
+    # makes a single run_async for both. history only goes out once the login succeeded, so a
+    # wrong password costs one check, and by then the tool list is cached for the second call
+    result = await mcp_login(username, password)
+    if "Login successful" not in result:
+        return result, []
+    return result, await fetch_chat_history(username, password, limit=limit)
+
+
 #Chat History
 
 # also called directly from the UI, not agent tools
 
-async def fetch_chat_history(username: str, password: str, limit: int = 100) -> list[dict]:
+async def fetch_chat_history(username: str, password: str, limit: int = 100, offset: int = 0) -> list[dict]:
     # returns messages as [{"role": "user"/"assistant", "content": "..."}]
     # in chronological order, ready to be fed into the agent
-    tools = await get_mcp_tools()
-    tool = _find_tool(tools, "get_chat_history_raw")
+    tool = await _find_tool("get_chat_history_raw")
     if not tool:
         return []
 
-    result = await tool.coroutine(username=username, password=password, limit=limit)
+    result = await tool.coroutine(username=username, password=password, limit=limit, offset=offset)
     text = _extract_mcp_result(result)
 
     try:
-        return json.loads(text)
-    except (json.JSONDecodeError, TypeError):
+        return orjson.loads(text)
+    except (orjson.JSONDecodeError, TypeError):
         # if parsing fails just return empty, not worth crashing over
         return []
 
 
 async def save_chat_exchange_direct(username: str, password: str, user_message: str, assistant_message: str) -> bool:
     # save both sides of the conversation after each turn
-    tools = await get_mcp_tools()
-    tool = _find_tool(tools, "save_chat_exchange")
+    tool = await _find_tool("save_chat_exchange")
     if not tool:
         return False
 
@@ -120,12 +150,12 @@ async def save_chat_exchange_direct(username: str, password: str, user_message:
     )
     text = _extract_mcp_result(result)
     logger.info(f"saved chat exchange for '{username}': {text}")
-    return "saved" in text.lower()
+    # exact match, the failure message mentions saving too
+    return text == "Chat exchange saved"
 
 
 async def clear_chat_history_direct(username: str, password: str) -> bool:
-    tools = await get_mcp_tools()
-    tool = _find_tool(tools, "clear_chat_history")
+    tool = await _find_tool("clear_chat_history")
     if not tool:
         return False
 
@@ -199,6 +229,11 @@ PYTHON_TYPE_MAP = {
 }
 
 
+# stripped schemas don't depend on the user, so each one is only built once per tool signature
+# keyed on the schema itself so a redeployed tool with new args gets a new model
+MODEL_CACHE: dict[tuple[str, bytes], Any] = {}
+
+
 def _build_model_without_credentials(tool_name: str, tool) -> Any:
     # we strip username/password from every tool's schema before handing them to the LLM
     # so the model never has to know or pass credentials — we inject them ourselves
@@ -211,6 +246,10 @@ def _build_model_without_credentials(tool_name: str, tool) -> Any:
     else:
         schema = {}
 
+    key = (tool_name, orjson.dumps(schema, option=orjson.OPT_SORT_KEYS, default=str))
+    if key in MODEL_CACHE:
+        return MODEL_CACHE[key]
+
     properties = schema.get("properties", {})
     required_fields = schema.get("required", [])
 
@@ -231,22 +270,24 @@ def _build_model_without_credentials(tool_name: str, tool) -> Any:
                 pydantic.Field(default=default, description=description)
             )
 
-    return pydantic.create_model(tool_name + "Input", **fields)
+    model = MODEL_CACHE[key] = pydantic.create_model(tool_name + "Input", **fields)
+    return model
+
+
+# skip auth and chat history tools — the LLM doesn't need these,
+# they're handled directly by the UI
+SKIP_TOOLS = frozenset({
+    "register_user", "login_user", "change_password",
+    "save_chat_message", "save_chat_exchange",
+    "get_chat_history", "get_chat_history_raw", "clear_chat_history"
+})
 
 
 def inject_credentials_into_tools(mcp_tools, username: str, password: str):
     wrapped = []
 
-    # skip auth and chat history tools — the LLM doesn't need these,
-    # they're handled directly by the UI
-    skip_tools = {
-        "register_user", "login_user", "change_password",
-        "save_chat_message", "save_chat_exchange",
-        "get_chat_history", "get_chat_history_raw", "clear_chat_history"
-    }
-
     for tool in mcp_tools:
-        if tool.name in skip_tools:
+        if tool.name in SKIP_TOOLS:
             continue
 
         new_schema = _build_model_without_credentials(tool.name, tool)
@@ -317,16 +358,17 @@ async def build_app(username: str, password: str, name: str):
     return app
 
 
-async def run_agent(history, username: str, password: str, name: str):
-    app = await build_app(username, password, name)
-    final_state = None
+async def get_app(username: str, password: str, name: str):
+    # building means a tool fetch, a pydantic model per tool and a graph compile —
+    # only do it on the user's first turn, not every message
+    key = (username, hashlib.sha256(password.encode()).hexdigest())
+    app = APP_CACHE.get(key)
+    if app is None:
+        app = APP_CACHE[key] = await build_app(username, password, name)
+    return app
 
-    async for state in app.astream(
-        {"messages": history},
-        {"recursion_limit": 10},
-    ):
-        final_state = state
 
+def _last_node_messages(final_state) -> list:
     if not final_state:
         return []
 
@@ -336,4 +378,39 @@ async def run_agent(history, username: str, password: str, name: str):
     elif "tools" in final_state:
         return final_state["tools"]["messages"]
 
-    return []
\ No newline at end of file
+    return []
+
+
+async def run_agent(history, username: str, password: str, name: str):
+    app = await get_app(username, password, name)
+    final_state = None
+
+    async for state in app.astream(
+        {"messages": history},
+        {"recursion_limit": 10},
+    ):
+        final_state = state
+
+    return _last_node_messages(final_state)
+
+
+async def stream_agent(history, username: str, password: str, name: str):
+    # same as run_agent but yields ("token", text) while the model is still writing,
+    # then ("final", messages) with exactly what run_agent would have returned
+    app = await get_app(username, password, name)
+    final_state = None
+
+    async for mode, chunk in app.astream(
+        {"messages": history},
+        {"recursion_limit": 10},
+        stream_mode=["messages", "updates"],
+    ):
+        if mode == "messages":
+            msg, metadata = chunk
+            # tool-call rounds stream too but carry no text, only pass on the agent's words
+            if metadata.get("langgraph_node") == "agent" and isinstance(msg.content, str) and msg.content:
+                yield "token", msg.content
+        else:
+            final_state = chunk
+
+    yield "final", _last_node_messages(final_state)
@@ -1,13 +1,15 @@
 import asyncio
+import queue
 import threading
+from functools import lru_cache
 import streamlit as st
 
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from agent_graph import (
-    run_agent,
+    stream_agent,
     build_system_prompt,
     build_history_as_messages,
-    mcp_login,
+    mcp_login_with_history,
     mcp_register,
     fetch_chat_history,
     save_chat_exchange_direct,
@@ -21,28 +23,73 @@ st.set_page_config(page_title="Expense Tracker AI", layout="centered")
 # Helpers
 
 # run async functions from sync context (streamlit doesn't play well with asyncio)
+# one event loop for the whole process, running forever on a daemon thread, so connection
+# pools and clients created on it survive between turns instead of dying with a per-call loop
+# uvloop is a faster drop-in loop for all the network round trips, not available on windows
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    try:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
 def run_async(coro):
-    result = None
-    exception = None
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
 
-    def thread_target():
-        nonlocal result, exception
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+
+# fire and forget, for things the page doesn't need to wait on (like saving chat history)
+def run_async_background(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+# same idea for async generators: the generator is drained on the background loop
+# and hands items back through a queue as they come, so the page can update mid-run
+def stream_async(agen):
+    items = queue.Queue()
+    done = object()
+
+    async def drain():
         try:
-            result = loop.run_until_complete(coro)
-        except Exception as e:
-            exception = e
+            async for item in agen:
+                items.put(item)
+        except (Exception, asyncio.CancelledError) as e:
+            # cancellation is forwarded too, otherwise the stream just ends with an empty reply
+            items.put(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
         finally:
-            loop.close()
+            items.put(done)
+
+    fut = asyncio.run_coroutine_threadsafe(drain(), get_event_loop())
+
+    # if streamlit abandons us (stop, rerun, new message) the agent must stop too,
+    # not keep calling tools like add_expense after the user moved on
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        fut.cancel()
 
-    t = threading.Thread(target=thread_target)
-    t.start()
-    t.join()
 
-    if exception:
-        raise exception
-    return result
+# one groq client for guest chat, shared across reruns and sessions instead of built per message
+@st.cache_resource
+def get_guest_llm():
+    from langchain_groq import ChatGroq
+    return ChatGroq(model="llama-3.3-70b-versatile")
+
+
+# simple system prompt for guests, nudges them to login for expense stuff
+GUEST_SYSTEM = SystemMessage(content=(
+    "You are a helpful AI assistant. Chat freely on any topic. "
+    "If the user asks to track, save, or manage expenses, politely tell them "
+    "they need to login first to use expense tracking features."
+))
 
 
 # AI sometimes returns content as a list of blocks, this just pulls the text out
@@ -76,6 +123,55 @@ def raw_to_pairs(raw: list[dict]) -> list[tuple[str, str]]:
     return pairs
 
 
+HISTORY_PAGE = 40  # messages per history fetch, login only pulls the most recent page
+
+
+def settle_saves(wait: bool = False):
+    # saves from earlier turns run in the background, only the ones that made it into the DB
+    # move the paging offset, and the user hears about the ones that didn't
+    # wait=True blocks on in-flight saves so the next page fetch sees a settled DB
+    still_pending = []
+    for fut in st.session_state.pending_saves:
+        if not wait and not fut.done():
+            still_pending.append(fut)
+            continue
+        try:
+            saved = fut.result()
+        except Exception:
+            saved = False
+        if saved:
+            st.session_state.history_loaded += 2
+        else:
+            st.toast("Couldn't save a message to your chat history.")
+    st.session_state.pending_saves = still_pending
+
+
+def load_older_history():
+    # pull the next page of older messages from the server and put them in front of what we have
+    settle_saves(wait=True)
+    raw = run_async(fetch_chat_history(
+        st.session_state.username,
+        st.session_state.password,
+        limit=HISTORY_PAGE,
+        offset=st.session_state.history_loaded,
+    ))
+    older = raw_to_pairs(raw)
+    st.session_state.pairs[:0] = older
+    st.session_state.history_loaded += len(raw)
+    st.session_state.history_more = len(raw) == HISTORY_PAGE
+
+    # indexes shift when pairs are added in front
+    if st.session_state.active_thread != -1:
+        st.session_state.active_thread += len(older)
+
+
+# sidebar label for a thread, the same messages show up every rerun so it's only built once
+@lru_cache(maxsize=1024)
+def thread_preview(user_msg: str) -> str:
+    # truncate long messages so the sidebar doesn't get ugly
+    return "💬  " + user_msg[:36] + ("…" if len(user_msg) > 36 else "")
+
+
 def start_new_chat():
     # just reset everything, history stays in the DB/sidebar
     system_prompt = build_system_prompt(st.session_state.username, st.session_state.name)
@@ -106,8 +202,12 @@ defaults = {
     "history": [],
     "guest_history": [],
     "page": "chat",
-    "raw_history": [],
+    "pairs": [],  # (user, assistant) exchanges for the sidebar, built once at login and appended to after
     "active_thread": -1,  # -1 means new chat, anything else is an index into pairs
+    "pending_saves": [],  # background chat saves we haven't checked on yet
+    "threads_shown": 20,  # how many of the most recent threads get a sidebar button
+    "history_loaded": 0,  # messages fetched (or confirmed saved) so far, the offset for the next page
+    "history_more": False,  # whether the server might have older messages we haven't fetched
 }
 for k, v in defaults.items():
     if k not in st.session_state:
@@ -149,22 +249,13 @@ def render_guest_chat():
             st.markdown(user_text)
         st.session_state.guest_history.append(HumanMessage(content=user_text))
 
-        with st.spinner("Thinking..."):
-            from langchain_groq import ChatGroq
-            llm = ChatGroq(model="llama-3.3-70b-versatile")
-
-            # simple system prompt for guests, nudges them to login for expense stuff
-            guest_system = SystemMessage(content=(
-                "You are a helpful AI assistant. Chat freely on any topic. "
-                "If the user asks to track, save, or manage expenses, politely tell them "
-                "they need to login first to use expense tracking features."
-            ))
-            response = llm.invoke([guest_system] + list(st.session_state.guest_history))
-
-        st.session_state.guest_history.append(response)
+        # stream the reply in as it's generated, write_stream hands back the full text at the end
         with st.chat_message("assistant"):
-            st.markdown(extract_text(response.content))
-        st.rerun()
+            chunks = get_guest_llm().stream([GUEST_SYSTEM, *st.session_state.guest_history])
+            reply = st.write_stream(extract_text(chunk.content) for chunk in chunks)
+
+        # both messages are already on screen and nothing else on the page changes, so no rerun
+        st.session_state.guest_history.append(AIMessage(content=reply))
 
 
 # Login Page
@@ -190,7 +281,9 @@ def render_login():
             st.error("Please fill in all fields.")
         else:
             with st.spinner("Logging in..."):
-                result = run_async(mcp_login(username.strip().lower(), password))
+                result, raw_history = run_async(
+                    mcp_login_with_history(username.strip().lower(), password, limit=HISTORY_PAGE)
+                )
 
             if "Login successful" in result or "Welcome back" in result:
                 # try to pull the actual name from the response message
@@ -200,16 +293,13 @@ def render_login():
                         name = line.replace("Welcome back,", "").replace("!", "").strip()
                         break
 
-                with st.spinner("Loading your history..."):
-                    raw_history = run_async(
-                        fetch_chat_history(username.strip().lower(), password, limit=200)
-                    )
-
                 st.session_state.logged_in = True
                 st.session_state.username = username.strip().lower()
                 st.session_state.password = password
                 st.session_state.name = name
-                st.session_state.raw_history = raw_history
+                st.session_state.pairs = raw_to_pairs(raw_history)
+                st.session_state.history_loaded = len(raw_history)
+                st.session_state.history_more = len(raw_history) == HISTORY_PAGE
 
                 # start fresh, old chats are accessible via sidebar
                 system_prompt = build_system_prompt(username.strip().lower(), name)
@@ -275,10 +365,11 @@ def render_register():
 
 # Logged-in Chat
 def render_chat():
-    raw = st.session_state.get("raw_history", [])
-    pairs = raw_to_pairs(raw)
+    pairs = st.session_state.pairs
     active = st.session_state.get("active_thread", -1)
 
+    settle_saves()
+
     with st.sidebar:
         st.markdown(f"### {st.session_state.name}")
         st.caption(f"@{st.session_state.username}")
@@ -297,19 +388,27 @@ def render_chat():
         if pairs:
             st.write("")
             st.caption("Previous chats")
-            for idx, (user_msg, _) in enumerate(pairs):
-                # truncate long messages so the sidebar doesn't get ugly
-                preview = "💬  " + user_msg[:36] + ("…" if len(user_msg) > 36 else "")
+            # only the most recent threads get buttons, heavy users can page back through the rest
+            # once everything we have is showing, the next page comes from the server
+            start = max(0, len(pairs) - st.session_state.threads_shown)
+            if start or st.session_state.history_more:
+                if st.button("Show older chats", key="show_older", use_container_width=True):
+                    if not start:
+                        load_older_history()
+                    st.session_state.threads_shown += 20
+                    st.rerun()
+            for idx, (user_msg, _) in enumerate(pairs[start:], start):
                 is_active = (active == idx)
                 btn_type = "primary" if is_active else "secondary"
-                if st.button(preview, key=f"thread_{idx}", type=btn_type, use_container_width=True):
+                if st.button(thread_preview(user_msg), key=f"thread_{idx}", type=btn_type, use_container_width=True):
                     load_thread(pairs, idx)
                     st.rerun()
 
         st.divider()
         if st.button("Logout", type="secondary", use_container_width=True):
             for key in ["logged_in", "username", "password", "name",
-                        "history", "raw_history", "active_thread"]:
+                        "history", "pairs", "active_thread", "pending_saves", "threads_shown",
+                        "history_loaded", "history_more"]:
                 st.session_state.pop(key, None)
             st.session_state.page = "chat"
             st.session_state.guest_history = []
@@ -339,45 +438,51 @@ def render_chat():
 
         st.session_state.history.append(HumanMessage(content=user_text))
 
-        with st.spinner("Thinking..."):
-            new_messages = run_async(run_agent(
-                st.session_state.history,
-                st.session_state.username,
-                st.session_state.password,
-                st.session_state.name
-            ))
-
-        # add new messages to history and grab the last assistant reply for saving
+        # stream the reply into the bubble as it's generated instead of waiting for all of it
+        new_messages = []
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            streamed = ""
+            with st.spinner("Thinking..."):
+                for kind, data in stream_async(stream_agent(
+                    st.session_state.history,
+                    st.session_state.username,
+                    st.session_state.password,
+                    st.session_state.name
+                )):
+                    if kind == "token":
+                        streamed += data
+                        placeholder.markdown(streamed + "▌")
+                    else:
+                        new_messages = data
+
+        # new_messages is only what the last graph node returned this turn, none of it can
+        # already be in history — so append straight away, no O(n) `in` scan per message
+        st.session_state.history.extend(new_messages)
+
+        # grab the last assistant reply for saving
         assistant_reply = ""
         for msg in new_messages:
-            if msg not in st.session_state.history:
-                st.session_state.history.append(msg)
             if isinstance(msg, AIMessage) and not getattr(msg, "tool_calls", None):
                 assistant_reply = extract_text(msg.content)
 
-        # show only the first real assistant message (skip tool call messages)
-        for msg in new_messages:
-            if isinstance(msg, AIMessage) and not getattr(msg, "tool_calls", None):
-                with st.chat_message("assistant"):
-                    st.markdown(extract_text(msg.content))
-                break
+        # swap the streamed text (and cursor) for the final reply
+        placeholder.markdown(assistant_reply)
 
         if assistant_reply:
-            # save to DB so it shows up in sidebar next time
-            run_async(save_chat_exchange_direct(
+            # save to DB so it shows up in sidebar next time, no need to hold up the rerun for it
+            st.session_state.pending_saves.append(run_async_background(save_chat_exchange_direct(
                 st.session_state.username,
                 st.session_state.password,
                 user_text,
                 assistant_reply
-            ))
+            )))
 
-            # keep local raw_history in sync so we don't need a full page reload
-            st.session_state.raw_history.append({"role": "user", "content": user_text})
-            st.session_state.raw_history.append({"role": "assistant", "content": assistant_reply})
+            # keep the local pairs in sync so we don't need a full page reload
+            st.session_state.pairs.append((user_text, assistant_reply))
 
             # move active thread pointer to the latest exchange
-            updated_pairs = raw_to_pairs(st.session_state.raw_history)
-            st.session_state.active_thread = len(updated_pairs) - 1
+            st.session_state.active_thread = len(st.session_state.pairs) - 1
 
         st.rerun()
 